@@ -1,14 +1,18 @@
 #!/usr/bin/env python
+import time
+# used by --timing to report how long the module import took
+IMPORT_START = time.time()
 import sys
 import os
-import gzip
 import re
+import errno
+import math
 import argparse
-import time
-import arrow
-import datetime
-from logbook import Logger
-from logbook import FileHandler
+
+# arrow, logbook, gzip and lzma are slow to import,
+# therefore they are imported only in the functions that need them
+# arrow is needed for every line, it is imported once by load_arrow()
+arrow = None
 
 
 # import ptvsd
@@ -23,15 +27,76 @@ from logbook import FileHandler
 MAX_LINES_TO_READ = 10000000
 # max file size in megabytes
 MAX_FILE_SIZE = "50M"
-# where to write application log
+# where to write application log, if --log-file is given without a file name
 LOG_FILE_NAME = "reican.log"
 
 TIMESTAMP_FORMAT = "YYYY-MM-DD HH:mm:ss"
 
-log_handler = FileHandler(LOG_FILE_NAME)
-log_handler.push_application()
-log = Logger("Reican")
-log.info("Logging started")
+# line length percentiles reported for every hour
+LINE_LENGTH_PERCENTILES = (50, 95, 99)
+
+# bucket size in seconds for --output json and csv
+BUCKET_SECONDS = 3600
+# columns of --output csv, --output json also includes per group counts with --group-by
+OUTPUT_FIELDS = ["start", "time", "lines", "bytes", "continuations", "max"] + [
+    "p{}".format(percentile) for percentile in LINE_LENGTH_PERCENTILES
+]
+
+# how many of the biggest per-bucket changes to list in --compare mode
+TOP_MOVERS = 5
+
+# max number of distinct --group-by keys tracked,
+# anything beyond that is counted in the OTHER_GROUP_KEY bucket
+MAX_GROUP_KEYS = 20
+OTHER_GROUP_KEY = "other"
+
+# built-in --group-by extractors, each regex captures the key in the 'key' group
+# [2017/03/19 10:39:31] minidlna.c:1004: warn: Starting MiniDLNA
+# [2015-10-31 10:10:53.382999] DEBUG: Reican: Using gzip to open the file
+GROUP_BY_EXTRACTORS = {
+    "level": "(?i)\\b(?P<key>debug|info|notice|warn|warning|error|critical|fatal):",
+    "source": "\]\s+(?P<key>[\w\.\-]+\.\w+:[0-9]+):",
+    "component": "\]\s+(?:[A-Z]+:\s+)?(?P<key>[\w\.\-]+?)(?::[0-9]+)?:\s"
+}
+
+
+
+class NullLogger:
+    """Discard all log records, used until logging is set up by setup_logging()."""
+
+    def discard(self, *args, **kwargs):
+        pass
+
+    debug = info = warn = warning = error = critical = discard
+
+
+log = NullLogger()
+
+
+def setup_logging(log_file_name):
+    """Start logging to 'log_file_name' and return the log handler."""
+    global log
+    from logbook import Logger
+    from logbook import FileHandler
+    log_handler = FileHandler(log_file_name)
+    log_handler.push_application()
+    log = Logger("Reican")
+    log.info("Logging started")
+    return log_handler
+
+
+def load_arrow():
+    """Import arrow on first use and return it."""
+    global arrow
+    if arrow is None:
+        import arrow as arrow_module
+        arrow = arrow_module
+    return arrow
+
+
+def logging_enabled():
+    """Return True if setup_logging() has been called."""
+    return not isinstance(log, NullLogger)
 
 
 def func_log(function_name):
@@ -39,6 +104,9 @@ def func_log(function_name):
 
     def log_it(*args, **kwargs):
         """Log function and its args, execute the function and return the result."""
+        if not logging_enabled():
+            # skip the timing and formatting if nobody will see the result
+            return function_name(*args, **kwargs)
         t_start = time.time()
         result = function_name(*args, **kwargs)
         t_end = time.time() - t_start
@@ -80,6 +148,7 @@ def get_opener(file_name, stats):
     Return 'open' object that can afterwards be iterated.
     """
     if file_name.endswith("gz"):
+        import gzip
         log.debug("Using gzip to open the file")
         opener = gzip.open
         stats.compressed = True
@@ -107,6 +176,19 @@ class Stats:
         self.size = get_size(file_name)
         self.compressed = False
         self.bytes_per_line = None
+        # raw (undecoded, uncompressed) size of every parsed record, including the newline
+        self.line_sizes = {}
+        # number of continuation lines attached to each record
+        self.line_continuations = {}
+        self.continuation_lines = 0
+        self.continuation_bytes = 0
+        # continuation lines found before the first record
+        self.orphan_lines = 0
+        self.per_hour_continuations = {}
+        self.bytes = 0
+        self.max_line_length = 0
+        self.per_hour_bytes = {}
+        self.per_hour_line_length = {}
         self.times = {'start': None, 'stop': None, 'delta': None}
         self.per_hour_aggregation = {}
         self.per_day_aggregation = {}
@@ -115,6 +197,12 @@ class Stats:
         self.lines = {}
         self.filter_string = None
         self.filter_date = None
+        # compiled --group-by regex and the per-line keys it extracted
+        self.group_by = None
+        self.group_keys = set()
+        self.line_groups = {}
+        self.group_totals = {}
+        self.per_hour_group_aggregation = {}
         # will be set to True once analyzed
         self.analyzed = False
 
@@ -126,6 +214,21 @@ class Stats:
     def increment_line_counter(self):
         self.line_counter += 1
 
+    def add_group_key(self, key):
+        """
+        Return the key the line should be counted under.
+
+        Once MAX_GROUP_KEYS distinct keys have been seen,
+        any new key is folded into the OTHER_GROUP_KEY bucket.
+        """
+        if key is None:
+            return OTHER_GROUP_KEY
+        if key not in self.group_keys:
+            if len(self.group_keys) >= MAX_GROUP_KEYS:
+                return OTHER_GROUP_KEY
+            self.group_keys.add(key)
+        return key
+
 
 def get_timestamp(line):
     """
@@ -161,10 +264,8 @@ def get_timestamp(line):
             time_format = regexes[regex]
             break
     else:
-        log.error("Could not match the timestamp")
-        log.error(line)
         # if timestamp was not macthed, None will be returned
-        # and  the line will be skipped
+        # and the line will be treated as a continuation line
         return None, None
     if len(r.groups()) == 1:
         return r.groups()[0], time_format
@@ -172,10 +273,64 @@ def get_timestamp(line):
         return False, False
 
 
+def get_group_regex(group_by):
+    """
+    Return compiled regex for the --group-by option.
+
+    'group_by' is either a name of a built-in extractor (see GROUP_BY_EXTRACTORS)
+    or a regex with a named group 'key' (or exactly one unnamed group).
+    Returns None if the regex is not usable.
+    """
+    expression = GROUP_BY_EXTRACTORS.get(group_by, group_by)
+    try:
+        regex = re.compile(expression)
+    except re.error as exc:
+        log.warn("Exception while compiling group-by regex '{}'".format(exc))
+        return None
+    if "key" not in regex.groupindex and regex.groups != 1:
+        log.warn("Group-by regex must have a 'key' group or a single group")
+        return None
+    return regex
+
+
+def get_group_key(line, regex):
+    """Return the group key found in the log line or None if there is none."""
+    r = regex.search(line)
+    if not r:
+        return None
+    if "key" in regex.groupindex:
+        return r.group("key")
+    return r.group(1)
+
+
 def get_time(log_line):
     """Parse log line and return timestamp."""
+    if arrow is None:
+        load_arrow()
     # use arrow module to translate timestamp to python datetime object
     timestamp, time_format = get_timestamp(log_line)
+    if not timestamp:
+        return None
+    return parse_timestamp(timestamp, time_format)
+
+
+def get_hour_key(timestamp):
+    """
+    Return a string that changes whenever the hour of a get_timestamp() timestamp changes.
+
+    Cheap enough to be used on every record without parsing the timestamp.
+    """
+    # epoch timestamps, e.g. 1446314353.403
+    if timestamp[:10].isdigit():
+        return str(int(float(timestamp)) // 3600)
+    # everything else starts with year, month, day and hour, e.g. 2017/03/19 10
+    return timestamp[:13]
+
+
+def parse_timestamp(timestamp, time_format):
+    """Turn a timestamp found by get_timestamp() into an arrow object."""
+    if arrow is None:
+        load_arrow()
     # some time formats are not recognized by arrow,
     # therefore, if needed, a 'time_format' string is passed to arrow
     if time_format:
@@ -185,6 +340,28 @@ def get_time(log_line):
     return time
 
 
+def get_line_class(line):
+    """
+    Return the kind of the first character of the line.
+
+    Used as a cheap check if the line can be the first line of a record:
+    once the first timestamped line is found, lines starting with another kind
+    of character are treated as continuation lines without looking for a timestamp.
+    Leading NUL bytes are ignored, they are left behind by copytruncate log rotation.
+    """
+    line = line.lstrip("\x00")
+    if not line:
+        return None
+    first = line[0]
+    if first.isdigit():
+        return "digit"
+    if first.isalpha():
+        return "alpha"
+    if first.isspace():
+        return "space"
+    return first
+
+
 def is_same_day(date1, date2):
     """Compare two dates in arrow format and return True if they are the same day."""
     return date1.date() == date2.date()
@@ -266,16 +443,79 @@ def parse_args():
     parser.add_argument('file_name', help="Log file to parse")
     parser.add_argument('--filter', help="Filter string to search for")
     parser.add_argument('--date', help="Date string to search for")
+    parser.add_argument(
+        '--log-file',
+        nargs='?',
+        const=LOG_FILE_NAME,
+        help="Write application log to this file ({} if no file name is given)".
+        format(LOG_FILE_NAME))
+    parser.add_argument(
+        '--timing',
+        action='store_true',
+        help="Print import and startup time to stderr")
+    parser.add_argument(
+        '--group-by',
+        help="Break down per hour counts by a key: one of {} or a regex "
+        "with a named group 'key'".format(", ".join(
+            sorted(GROUP_BY_EXTRACTORS))))
+    parser.add_argument(
+        '--output',
+        choices=['text', 'json', 'csv'],
+        default='text',
+        help="Output format. json (one object per line) and csv "
+        "write every hour as soon as it has been read")
+    parser.add_argument(
+        '--export',
+        help="Write the per hour aggregation to this file as JSON, "
+        "to be used with --compare-export later")
+    parser.add_argument('--compare', help="Log file to compare against")
+    parser.add_argument(
+        '--compare-export',
+        help="Aggregation written by --export to compare against")
+    parser.add_argument(
+        '--compare-date',
+        help="Date to compare --date against. "
+        "If --compare is not set, the same log file is used")
+    parser.add_argument(
+        '--align',
+        choices=['time', 'hour'],
+        default='time',
+        help="Align compared buckets by absolute time or by hour of day")
 
     args = parser.parse_args()
-    # try to parse the provided date, but if that die()'
-    if args.date:
+    # try to parse the provided dates, but if that fails die()'
+    for date_option in ('date', 'compare_date'):
+        date = getattr(args, date_option)
+        if not date:
+            continue
+        load_arrow()
         try:
-            args.date = arrow.get(args.date)
+            setattr(args, date_option, arrow.get(date))
         except (arrow.parser.ParserError, TypeError) as exc:
             log.warn("Exception while parsing date '{}'".format(exc))
-            log.warn("Could not parse date '{}'".format(args.date))
+            log.warn("Could not parse date '{}'".format(date))
             die("Invalid date specified")
+    if args.group_by:
+        args.group_by = get_group_regex(args.group_by)
+        if not args.group_by:
+            die("Invalid group-by specified")
+    if args.compare or args.compare_export or args.compare_date:
+        # compare mode only prints the comparison table
+        if args.output != 'text' or args.export or args.group_by:
+            die("--compare, --compare-export and --compare-date can not be "
+                "combined with --output, --export or --group-by")
+    if args.compare and args.compare_export:
+        die("--compare and --compare-export can not be used together")
+    if args.compare_export and args.compare_date:
+        # exported aggregations have been filtered when they were exported
+        die("--compare-date can not be combined with --compare-export")
+    if args.compare_date and not args.date:
+        die("--compare-date requires --date")
+    if args.output != 'text' and args.export:
+        die("--export can not be combined with --output {}".format(args.output))
+    if args.output == 'csv' and args.group_by:
+        # per group counts do not fit a fixed set of columns
+        die("--group-by can not be combined with --output csv, use --output json")
     return args
 
 
@@ -314,17 +554,92 @@ def print_summary(stats):
     else:
         print "."
     print "{} lines parsed".format(stats.line_counter)
+    if stats.continuation_lines:
+        print "{} continuation lines, {} bytes".format(
+            stats.continuation_lines, stats.continuation_bytes)
+    if stats.orphan_lines:
+        print "{} lines before the first timestamp skipped".format(
+            stats.orphan_lines)
     print "File size: {} bytes, {} bytes per line".format(stats.size,
                                                           stats.bytes_per_line)
+    # stats.bytes only covers records that passed --filter and --date
+    print "Bytes in matching records: {}, longest record: {} bytes".format(
+        stats.bytes, stats.max_line_length)
     print "Start time: {}".format(stats.times['start'])
     print "Stop time: {}".format(stats.times['stop'])
 
-    print "Delta: {}".format(
-        human_delta_string(humanize_delta(stats.times['delta'])))
+    if stats.times['delta'] is not None:
+        print "Delta: {}".format(
+            human_delta_string(humanize_delta(stats.times['delta'])))
     keys = stats.per_hour_aggregation.keys()
     keys.sort()
+    columns = ["lines", "bytes", "max"]
+    columns += ["p{}".format(percentile) for percentile in LINE_LENGTH_PERCENTILES]
+    if stats.continuation_lines:
+        columns.append("cont")
+    rows = []
     for hour in keys:
-        print hour.format(TIMESTAMP_FORMAT), stats.per_hour_aggregation[hour]
+        line_length = stats.per_hour_line_length[hour]
+        row = [stats.per_hour_aggregation[hour], stats.per_hour_bytes[hour]]
+        row += [line_length["max"]]
+        row += [
+            line_length["p{}".format(percentile)]
+            for percentile in LINE_LENGTH_PERCENTILES
+        ]
+        if stats.continuation_lines:
+            row.append(stats.per_hour_continuations[hour])
+        rows.append([str(value) for value in row])
+    widths = [
+        max([len(column)] + [len(row[i]) for row in rows])
+        for i, column in enumerate(columns)
+    ]
+    header = [" " * len(TIMESTAMP_FORMAT)]
+    header += [column.rjust(width) for column, width in zip(columns, widths)]
+    print " ".join(header)
+    for hour, row in zip(keys, rows):
+        print hour.format(TIMESTAMP_FORMAT), " ".join(
+            value.rjust(width) for value, width in zip(row, widths))
+    if stats.group_by:
+        print_group_matrix(stats)
+
+
+def get_sorted_group_keys(stats):
+    """Return group keys sorted by total count, with 'other' always last."""
+    keys = [key for key in stats.group_totals if key != OTHER_GROUP_KEY]
+    keys.sort(key=lambda key: (-stats.group_totals[key], key))
+    if OTHER_GROUP_KEY in stats.group_totals:
+        keys.append(OTHER_GROUP_KEY)
+    return keys
+
+
+def print_group_matrix(stats):
+    """Print per hour counts as a matrix with one column per group key."""
+    group_keys = get_sorted_group_keys(stats)
+    widths = [
+        max(len(str(key)), len(str(stats.group_totals[key])))
+        for key in group_keys
+    ]
+    print "-" * 80
+    print "Group-by: '{}'".format(stats.group_by.pattern)
+    row = [" " * len(TIMESTAMP_FORMAT)]
+    row += [str(key).rjust(width) for key, width in zip(group_keys, widths)]
+    print " ".join(row)
+    hours = stats.per_hour_group_aggregation.keys()
+    hours.sort()
+    for hour in hours:
+        counts = stats.per_hour_group_aggregation[hour]
+        row = [hour.format(TIMESTAMP_FORMAT)]
+        row += [
+            str(counts.get(key, 0)).rjust(width)
+            for key, width in zip(group_keys, widths)
+        ]
+        print " ".join(row)
+    row = ["total".ljust(len(TIMESTAMP_FORMAT))]
+    row += [
+        str(stats.group_totals[key]).rjust(width)
+        for key, width in zip(group_keys, widths)
+    ]
+    print " ".join(row)
 
 
 @func_log
@@ -376,9 +691,30 @@ class ProgressTracker:
 
 
 
+def get_percentile(sorted_values, percentile):
+    """Return the nearest-rank percentile of an already sorted list."""
+    rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def get_line_length_stats(line_sizes):
+    """Return max and LINE_LENGTH_PERCENTILES line lengths for a list of line sizes."""
+    line_sizes = sorted(line_sizes)
+    line_length_stats = {'max': line_sizes[-1]}
+    for percentile in LINE_LENGTH_PERCENTILES:
+        line_length_stats['p{}'.format(percentile)] = get_percentile(
+            line_sizes, percentile)
+    return line_length_stats
+
+
 def analyze_stats(stats):
     """Iterate over the 'stats' and sort lines into per-hour buckets."""
-    for line in stats.lines:
+    load_arrow()
+    per_hour_groups = {}
+    per_hour_sizes = {}
+    per_hour_continuations = {}
+    # record line numbers are not contiguous, sort them to keep the file order
+    for line in sorted(stats.lines):
         time = stats.lines[line]
         stats.increment_line_counter()
         # save first timestamp found so that delta can be calculated later
@@ -404,6 +740,21 @@ def analyze_stats(stats):
             stats.aggregation[year][month][day][hour] = 0
         # increment hour counter by 1
         stats.aggregation[year][month][day][hour] += 1
+        line_size = stats.line_sizes[line]
+        stats.bytes += line_size
+        stats.max_line_length = max(stats.max_line_length, line_size)
+        hour_key = (year, month, day, hour)
+        if hour_key not in per_hour_sizes:
+            per_hour_sizes[hour_key] = []
+        per_hour_sizes[hour_key].append(line_size)
+        per_hour_continuations[hour_key] = per_hour_continuations.get(
+            hour_key, 0) + stats.line_continuations.get(line, 0)
+        if stats.group_by:
+            group_key = stats.line_groups[line]
+            stats.group_totals[group_key] = stats.group_totals.get(group_key, 0) + 1
+            if hour_key not in per_hour_groups:
+                per_hour_groups[hour_key] = {}
+            per_hour_groups[hour_key][group_key] = per_hour_groups[hour_key].get(group_key, 0) + 1
     # for backwards compatibility, calculate per hour aggregation
     for year in stats.aggregation:
         for month in stats.aggregation[year]:
@@ -411,15 +762,118 @@ def analyze_stats(stats):
                 for hour in stats.aggregation[year][month][day]:
                     current_hour = arrow.get("{}-{:02d}-{:02d} {:02d}:00:00".format(year, month, day, hour))
                     stats.per_hour_aggregation[current_hour] = stats.aggregation[year][month][day][hour]
+                    line_sizes = per_hour_sizes[(year, month, day, hour)]
+                    stats.per_hour_bytes[current_hour] = sum(line_sizes)
+                    stats.per_hour_line_length[current_hour] = get_line_length_stats(line_sizes)
+                    stats.per_hour_continuations[current_hour] = per_hour_continuations[(year, month, day, hour)]
+                    if stats.group_by:
+                        stats.per_hour_group_aggregation[current_hour] = per_hour_groups[(year, month, day, hour)]
     # once all lines have been analyzed, calculate some summary data
-    stats.bytes_per_line = stats.size / stats.line_counter
-    stats.times['delta'] = stats.times['stop'] - stats.times['start']
+    if stats.line_counter:
+        # use the bytes actually read, 'size' is the compressed size for compressed files
+        stats.bytes_per_line = stats.bytes / stats.line_counter
+        stats.times['delta'] = stats.times['stop'] - stats.times['start']
     if stats.max_lines_reached():
         print "Max lines limit was reached, parsing incomplete"
         die()
     stats.analyzed = True
     return stats
 
+def finish_record(record, stats, filter_date=None):
+    """
+    Return the (line_number, time, size, continuations, line) tuple for a record.
+
+    Returns None if the filter string is not found in any line of the record
+    or the record is not from 'filter_date'.
+    The timestamp is only parsed here, once the record is known to match the filter string,
+    because parsing is by far the slowest part of reading a line.
+    """
+    if not record['matched']:
+        return None
+    time = parse_timestamp(record['timestamp'], record['time_format'])
+    log.debug("Got time: {}".format(time))
+    # if date has been specified, discard any records that do not match it
+    if filter_date and not is_same_day(time, filter_date):
+        log.debug("Skipping non-matching date {}".format(time))
+        return None
+    stats.continuation_lines += record['continuations']
+    stats.continuation_bytes += record['continuation_bytes']
+    return (record['line_number'], time, record['size'],
+            record['continuations'], record['line'])
+
+
+def read_records(logfile, stats, progress=None, on_record_start=None):
+    """
+    Read an open log file and yield every record in it.
+
+    A record is a timestamped line together with the continuation lines following it.
+    Records not matching the date, or not containing the filter string in any of their lines,
+    are skipped.
+    Yields (line_number, time, size, continuations, line) tuples,
+    where 'line' is the first line of the record.
+    If set, on_record_start() is called with get_hour_key() of every record, skipped or not,
+    after the preceding record has been yielded.
+    """
+    load_arrow()
+    filter_string = stats.filter_string
+    filter_date = None
+    if stats.filter_date:
+        filter_date = arrow.get(stats.filter_date)
+    line_number = 0
+    # get_line_class() of the first timestamped line, until it is known every line is checked
+    record_start_class = None
+    # the record being read, None until the first record is found
+    record = None
+    for line in logfile:
+        line_number += 1
+        if progress:
+            progress.increment()
+            progress.report()
+        if stats.max_lines_reached():
+            log.error("MAX_LINES_TO_READ reached")
+            break
+        # raw length of the undecoded line, used for byte volume statistics
+        line_size = len(line)
+        timestamp = None
+        line_class = get_line_class(line)
+        if record_start_class is None or line_class == record_start_class:
+            # only find the timestamp, it is parsed in finish_record()
+            timestamp, time_format = get_timestamp(line.strip())
+        if timestamp:
+            if record_start_class is None:
+                record_start_class = line_class
+            if record:
+                finished = finish_record(record, stats, filter_date)
+                if finished:
+                    yield finished
+            if on_record_start:
+                on_record_start(get_hour_key(timestamp))
+            record = {
+                'line_number': line_number,
+                'timestamp': timestamp,
+                'time_format': time_format,
+                'size': line_size,
+                'continuations': 0,
+                'continuation_bytes': 0,
+                'line': line,
+                'matched': not filter_string or filter_string in line
+            }
+            continue
+        # no timestamp, attach the line to the preceding record
+        if record is None:
+            stats.orphan_lines += 1
+        else:
+            record['size'] += line_size
+            record['continuations'] += 1
+            record['continuation_bytes'] += line_size
+            if not record['matched'] and filter_string in line:
+                record['matched'] = True
+    if record:
+        finished = finish_record(record, stats, filter_date)
+        if finished:
+            yield finished
+
+
 @func_log
 def parse_file(file_name, stats):
     """
@@ -428,54 +882,359 @@ def parse_file(file_name, stats):
     Read the file line by line.
     Ignore lines that do not match the filter string or the date.
     For every matching line, parse the date and add it to 'stats' object.
+    Lines without a timestamp are counted as a part of the preceding record.
     """
     opener = get_opener(file_name, stats)
     with opener(file_name) as logfile:
         progress = ProgressTracker(logfile)
-        # start iterating over lines, initially aim is to filter-out anything that can be skipped
-        # such as, lines not containing required string,
-        # not containing timestamps or not mathing the date that was requested
-        for line in logfile:
-            progress.increment()
-            progress.report()
-            if stats.filter_string:
-                if stats.filter_string not in line:
-                    # if filtering string is specified,
-                    # skip any lines that don't contain that string
-                    continue
-            if stats.max_lines_reached():
-                log.error("MAX_LINES_TO_READ reached")
-                break
-            line = line.strip()
-            # parse line and get the timestamp
-            time = get_time(line)
-            log.debug("Got time: {}".format(time))
-            # if date has been specified, discard any lines that do not match it
-            if stats.filter_date:
-                stats.filter_date = arrow.get(stats.filter_date)
-                if not is_same_day(time, stats.filter_date):
-                    log.debug("Skipping non-matching date {}".format(time))
-                    continue
-            if not time:
-                # skip the line if there's no timestamp
-                pass
+        for line_number, time, size, continuations, line in read_records(
+                logfile, stats, progress):
             # add the extracted line number and timestamp to stats object for later analysis
-            stats.lines[progress.current_line] = time
+            stats.lines[line_number] = time
+            stats.line_sizes[line_number] = size
+            if continuations:
+                stats.line_continuations[line_number] = continuations
+            if stats.group_by:
+                group_key = get_group_key(line, stats.group_by)
+                stats.line_groups[line_number] = stats.add_group_key(group_key)
     return stats
 
 
+def new_bucket(start, offset):
+    """
+    Return an empty bucket starting at 'start' seconds since epoch.
+
+    'offset' is the UTC offset of the timestamps in the bucket, in seconds.
+    """
+    return {
+        'start': start,
+        'offset': offset,
+        'lines': 0,
+        'bytes': 0,
+        'continuations': 0,
+        'sizes': [],
+        'groups': {}
+    }
+
+
+def finish_bucket(bucket):
+    """Turn a bucket into an output row."""
+    row = get_line_length_stats(bucket.pop('sizes'))
+    row.update(bucket)
+    # show the hour in the timestamps' own UTC offset, same as the text output
+    offset = row.pop('offset')
+    row['time'] = time.strftime("%Y-%m-%d %H:%M:%S",
+                                time.gmtime(row['start'] + offset))
+    if not row['groups']:
+        del row['groups']
+    return row
+
+
+def stream_buckets(file_name, stats, emit):
+    """
+    Read the file and call emit() with every per hour bucket as soon as it is complete.
+
+    A bucket is complete once a record from another hour is read,
+    including records skipped by the filter string or the date,
+    so only one bucket is kept in memory.
+    If the file is not ordered by time, the same hour can be emitted more than once.
+    Reading stops if emit() returns False.
+    """
+    opener = get_opener(file_name, stats)
+    # a dict, so that flush() can replace the bucket
+    current = {'bucket': None, 'hour_key': None, 'closed': False}
+
+    def flush():
+        if current['bucket']:
+            if emit(finish_bucket(current['bucket'])) is False:
+                # nobody is reading the output anymore
+                current['closed'] = True
+            current['bucket'] = None
+
+    def on_record_start(hour_key):
+        if hour_key != current['hour_key']:
+            flush()
+            current['hour_key'] = hour_key
+
+    with opener(file_name) as logfile:
+        for line_number, record_time, size, continuations, line in read_records(
+                logfile, stats, on_record_start=on_record_start):
+            if current['closed']:
+                return stats
+            stats.increment_line_counter()
+            # hours are counted in the timestamp's own UTC offset, like analyze_stats() does
+            offset = int(record_time.utcoffset().total_seconds())
+            local_timestamp = record_time.timestamp + offset
+            start = local_timestamp - local_timestamp % BUCKET_SECONDS - offset
+            bucket = current['bucket']
+            if not bucket or bucket['start'] != start:
+                flush()
+                if current['closed']:
+                    return stats
+                bucket = current['bucket'] = new_bucket(start, offset)
+            bucket['lines'] += 1
+            bucket['bytes'] += size
+            bucket['continuations'] += continuations
+            bucket['sizes'].append(size)
+            if stats.group_by:
+                group_key = stats.add_group_key(
+                    get_group_key(line, stats.group_by))
+                bucket['groups'][group_key] = bucket['groups'].get(
+                    group_key, 0) + 1
+    if stats.max_lines_reached():
+        # the last bucket is incomplete, do not emit it
+        # stdout is used for the output itself, so the message goes to stderr
+        sys.stderr.write("Max lines limit was reached, parsing incomplete\n")
+        die()
+    flush()
+    return stats
+
+
+def get_emitter(output, output_file=None):
+    """
+    Return a function that writes bucket rows to 'output_file' in the 'output' format.
+
+    Rows go to stdout if 'output_file' is not set.
+    Every row is flushed right away, so it can be consumed while the file is being read.
+    The function returns False once the reader has closed the output, e.g. '| head'.
+    """
+    if output_file is None:
+        output_file = sys.stdout
+    # set once the reader has closed the output
+    state = {'closed': False}
+
+    def write_and_flush(write, *args):
+        """Call write(*args) and flush, return False if the output has been closed."""
+        if state['closed']:
+            return False
+        try:
+            write(*args)
+            output_file.flush()
+        except IOError as exc:
+            if exc.errno != errno.EPIPE:
+                raise
+            log.debug("Output closed by the reader")
+            state['closed'] = True
+            return False
+        return True
+
+    if output == 'json':
+        import json
+
+        def emit(row):
+            return write_and_flush(output_file.write,
+                                   json.dumps(row, sort_keys=True) + "\n")
+    else:
+        import csv
+        writer = csv.DictWriter(output_file, OUTPUT_FIELDS)
+        write_and_flush(writer.writeheader)
+
+        def emit(row):
+            return write_and_flush(writer.writerow, row)
+
+    return emit
+
+
+def export_aggregation(aggregation, file_name):
+    """Write year/month/day/hour aggregation to a JSON file."""
+    import json
+    with open(file_name, "w") as export_file:
+        json.dump(aggregation, export_file, sort_keys=True)
+
+
+def load_aggregation(file_name):
+    """Read an aggregation written by export_aggregation()."""
+    import json
+    # JSON object keys are always strings, turn them back into integers
+    aggregation = {}
+    try:
+        with open(file_name) as export_file:
+            exported = json.load(export_file)
+        for year, months in exported.items():
+            for month, days in months.items():
+                for day, hours in days.items():
+                    for hour, count in hours.items():
+                        if not isinstance(count, int):
+                            raise ValueError("Invalid count '{}'".format(count))
+                        aggregation.setdefault(int(year), {}).setdefault(
+                            int(month), {}).setdefault(int(day),
+                                                       {})[int(hour)] = count
+    except (ValueError, TypeError, AttributeError) as exc:
+        log.warn("Exception while loading aggregation '{}'".format(exc))
+        die("File {} is not an exported aggregation".format(file_name))
+    return aggregation
+
+
+def get_aggregation(file_name, filter_string=None, filter_date=None):
+    """Return year/month/day/hour aggregation for a log file."""
+    check_if_file_is_valid(file_name)
+    stats = Stats(file_name)
+    stats.filter_string = filter_string
+    stats.filter_date = filter_date
+    stats = parse_file(file_name, stats)
+    stats = analyze_stats(stats)
+    return stats.aggregation
+
+
+def get_buckets(aggregation, align):
+    """
+    Flatten the aggregation into {bucket: count}.
+
+    With align='time' bucket is a (year, month, day, hour) tuple,
+    with align='hour' it is the hour of day and counts of all days are added up.
+    """
+    buckets = {}
+    for year in aggregation:
+        for month in aggregation[year]:
+            for day in aggregation[year][month]:
+                for hour in aggregation[year][month][day]:
+                    if align == 'hour':
+                        bucket = hour
+                    else:
+                        bucket = (year, month, day, hour)
+                    buckets[bucket] = buckets.get(
+                        bucket, 0) + aggregation[year][month][day][hour]
+    return buckets
+
+
+def compare_aggregations(aggregation, other_aggregation, align):
+    """
+    Compare two aggregations bucket by bucket.
+
+    Returns a list of (bucket, count, other_count, delta, ratio) tuples sorted by bucket,
+    ratio is None if the bucket is empty in the first aggregation.
+    """
+    buckets = get_buckets(aggregation, align)
+    other_buckets = get_buckets(other_aggregation, align)
+    comparison = []
+    for bucket in sorted(set(buckets) | set(other_buckets)):
+        count = buckets.get(bucket, 0)
+        other_count = other_buckets.get(bucket, 0)
+        ratio = None
+        if count:
+            ratio = other_count / float(count)
+        comparison.append(
+            (bucket, count, other_count, other_count - count, ratio))
+    return comparison
+
+
+def get_biggest_movers(comparison, limit=TOP_MOVERS):
+    """Return up to 'limit' changed buckets with the largest absolute delta first."""
+    movers = [row for row in comparison if row[3] != 0]
+    movers.sort(key=lambda row: (-abs(row[3]), row[0]))
+    return movers[:limit]
+
+
+def format_bucket(bucket):
+    """Return a human readable bucket name."""
+    if isinstance(bucket, tuple):
+        return "{}-{:02d}-{:02d} {:02d}:00:00".format(*bucket)
+    return "{:02d}:00".format(bucket)
+
+
+def format_ratio(ratio):
+    """Return ratio with two decimals or '-' if there is no ratio."""
+    if ratio is None:
+        return "-"
+    return "{:.2f}".format(ratio)
+
+
+def print_comparison(name, other_name, comparison, align):
+    """Print per bucket deltas and ratios followed by the biggest movers."""
+    print "-" * 80
+    print "Comparison of {} (a) and {} (b), aligned by {}".format(
+        name, other_name, "hour of day" if align == 'hour' else "time")
+    columns = ["a", "b", "delta", "ratio"]
+    rows = [[
+        format_bucket(bucket),
+        str(count),
+        str(other_count), "{:+d}".format(delta),
+        format_ratio(ratio)
+    ] for bucket, count, other_count, delta, ratio in comparison]
+    bucket_width = max([len(TIMESTAMP_FORMAT)] + [len(row[0]) for row in rows])
+    widths = [
+        max([len(column)] + [len(row[i + 1]) for row in rows])
+        for i, column in enumerate(columns)
+    ]
+    header = ["bucket".ljust(bucket_width)]
+    header += [column.rjust(width) for column, width in zip(columns, widths)]
+    print " ".join(header)
+    for row in rows:
+        print " ".join([row[0].ljust(bucket_width)] + [
+            value.rjust(width) for value, width in zip(row[1:], widths)
+        ])
+    print "Biggest movers:"
+    for bucket, count, other_count, delta, ratio in get_biggest_movers(
+            comparison):
+        print "{} {:+d} ({} -> {}, ratio {})".format(
+            format_bucket(bucket), delta, count, other_count,
+            format_ratio(ratio))
+
+
+def compare(args):
+    """Scan or load both inputs and print how the second differs from the first."""
+    aggregation = get_aggregation(args.file_name, args.filter, args.date)
+    name = args.file_name
+    if args.date:
+        name += " on {}".format(args.date.format("YYYY-MM-DD"))
+    if args.compare_export:
+        # exported aggregations are already filtered
+        if not os.path.exists(args.compare_export):
+            die("File {} does not exist".format(args.compare_export))
+        other_aggregation = load_aggregation(args.compare_export)
+        other_name = args.compare_export
+    else:
+        other_file_name = args.compare or args.file_name
+        other_date = args.compare_date or args.date
+        other_aggregation = get_aggregation(other_file_name, args.filter,
+                                            other_date)
+        other_name = other_file_name
+        if other_date:
+            other_name += " on {}".format(other_date.format("YYYY-MM-DD"))
+    comparison = compare_aggregations(aggregation, other_aggregation,
+                                      args.align)
+    print_comparison(name, other_name, comparison, args.align)
+
+
+def print_timing(startup_time, total_time):
+    """Print import, startup and total run time to stderr."""
+    sys.stderr.write("Import time: {:5.5f} sec\n".format(IMPORT_TIME))
+    sys.stderr.write("Startup time: {:5.5f} sec\n".format(startup_time))
+    sys.stderr.write("Total time: {:5.5f} sec\n".format(total_time))
+
+
 def main():
     """Main application logic goes here."""
     args = parse_args()
+    if args.log_file:
+        setup_logging(args.log_file)
+    startup_time = time.time() - IMPORT_START
+    if args.compare or args.compare_export or args.compare_date:
+        compare(args)
+        if args.timing:
+            print_timing(startup_time, time.time() - IMPORT_START)
+        return
     file_name = args.file_name
     stats = Stats(file_name)
     check_if_file_is_valid(file_name)
     stats.filter_string = args.filter
     stats.filter_date = args.date
+    stats.group_by = args.group_by
+    if args.output != 'text':
+        stream_buckets(file_name, stats, get_emitter(args.output))
+        if args.timing:
+            print_timing(startup_time, time.time() - IMPORT_START)
+        return
     stats = parse_file(file_name, stats)
     stats = analyze_stats(stats)
     print_summary(stats)
+    if args.export:
+        export_aggregation(stats.aggregation, args.export)
+    if args.timing:
+        print_timing(startup_time, time.time() - IMPORT_START)
+
 
+IMPORT_TIME = time.time() - IMPORT_START
 
 if __name__ == "__main__":
     main()
@@ -11,11 +11,14 @@ test_file_name = "test/test.log"
 test_file_name2 = "test/minidlna.log"
 
 test_file_name_compressed = "test/test.log.gz"
+test_file_name2_compressed = "test/minidlna.log.gz"
+test_file_name_java = "test/java.log"
 
 missing_test_file_name = "test/test_missing.log"
 
 test_file_name_size = 221
 test_file_name2_size = 221
+test_file_name2_bytes = 2130
 
 test_file_name_compressed_size = 44
 
@@ -254,7 +257,9 @@ def test_parse_file_compressed():
     stats = reican.parse_file(test_file_name_compressed, stats)
     assert isinstance(stats, reican.Stats)
     assert stats.size == test_file_name_compressed_size
-    assert len(stats.lines) == 3
+    # lines in test/test.log.gz have no timestamps, so there are no records
+    assert len(stats.lines) == 0
+    assert stats.orphan_lines == 3
     assert stats.compressed
 
 
@@ -301,4 +306,535 @@ def test_main_minidlna_log(capsys):
     reican.main()
     out, err = capsys.readouterr()
     assert "File size: 2130 bytes, 101 bytes per line" in out
+    assert "Bytes in matching records: 2130, longest record: 280 bytes" in out
+    assert "2017-03-25 17:00:00     2   162  81  81  81  81" in out
     assert "Delta: 32 days, 19 hours, 4 minutes, 59 seconds." in out
+
+
+#
+# Test --group-by
+#
+def test_args_group_by_extractor():
+    """Test --group-by with a built-in extractor name."""
+    sys.argv = ["./reican.py", "some_file_name", "--group-by", "level"]
+    args = reican.parse_args()
+    assert args.group_by.pattern == reican.GROUP_BY_EXTRACTORS["level"]
+
+
+def test_args_group_by_invalid():
+    """Test --group-by with a regex that cannot be compiled."""
+    sys.argv = ["./reican.py", "some_file_name", "--group-by", "("]
+    with pytest.raises(SystemExit):
+        reican.parse_args()
+
+
+def test_get_group_key():
+    test_string = "[2017/03/19 10:39:31] minidlna.c:1004: warn: Starting MiniDLNA"
+    assert reican.get_group_key(
+        test_string, reican.get_group_regex("level")) == "warn"
+    assert reican.get_group_key(
+        test_string, reican.get_group_regex("source")) == "minidlna.c:1004"
+    assert reican.get_group_key(
+        test_string, reican.get_group_regex("component")) == "minidlna.c"
+    assert reican.get_group_key(
+        test_string, reican.get_group_regex("(MiniDLNA)")) == "MiniDLNA"
+    assert reican.get_group_key(
+        test_string, reican.get_group_regex("nothing (here)")) is None
+
+
+def test_stats_add_group_key_cap():
+    """Keys beyond MAX_GROUP_KEYS must be folded into the 'other' bucket."""
+    s = reican.Stats(test_file_name)
+    with mock.patch.object(reican, "MAX_GROUP_KEYS", 2):
+        assert s.add_group_key("a") == "a"
+        assert s.add_group_key("b") == "b"
+        assert s.add_group_key("c") == reican.OTHER_GROUP_KEY
+        assert s.add_group_key("a") == "a"
+        assert s.add_group_key(None) == reican.OTHER_GROUP_KEY
+
+
+def test_analyze_stats_group_by():
+    """Test analyze_stats() with --group-by component on test/minidlna."""
+    stats = reican.Stats(test_file_name2)
+    stats.group_by = reican.get_group_regex("component")
+    stats = reican.parse_file(test_file_name2, stats)
+    stats = reican.analyze_stats(stats)
+    assert stats.group_totals == {
+        "upnphttp.c": 11,
+        "minidlna.c": 6,
+        "inotify.c": 2,
+        "playlist.c": 2
+    }
+    hour = arrow.get("2017-03-19 10:00:00")
+    assert stats.per_hour_group_aggregation[hour]["minidlna.c"] == 5
+    assert reican.get_sorted_group_keys(stats)[0] == "upnphttp.c"
+
+
+def test_main_group_by(capsys):
+    """Test the group-by matrix output against test/test.log."""
+    sys.argv = ["./reican.py", "test/test.log", "--group-by", "level"]
+    reican.main()
+    out, err = capsys.readouterr()
+    assert "                    ERROR DEBUG" in out
+    assert "2015-10-31 10:00:00     0     1" in out
+    assert "total                   2     1" in out
+
+
+#
+# Test startup behaviour
+#
+def test_import_is_lazy(tmpdir):
+    """Importing reican must not load heavy modules or create a log file."""
+    import os
+    import subprocess
+    code = ("import sys; import reican.reican; "
+            "print([m for m in ('arrow', 'logbook', 'gzip', 'backports.lzma') "
+            "if m in sys.modules])")
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    out = subprocess.check_output(
+        [sys.executable, "-c", code], cwd=str(tmpdir), env=env)
+    assert out.strip() == "[]"
+    assert tmpdir.listdir() == []
+
+
+def test_setup_logging(tmpdir, monkeypatch):
+    """Logging is set up only when requested."""
+    monkeypatch.setattr(reican, "log", reican.NullLogger())
+    assert reican.logging_enabled() is False
+    log_file_name = str(tmpdir.join("reican.log"))
+    log_handler = reican.setup_logging(log_file_name)
+    try:
+        assert reican.logging_enabled() is True
+        assert "Logging started" in open(log_file_name).read()
+    finally:
+        log_handler.pop_application()
+
+
+def test_main_timing(capsys):
+    """Test --timing output."""
+    sys.argv = ["./reican.py", "test/test.log", "--timing"]
+    reican.main()
+    out, err = capsys.readouterr()
+    assert "Import time:" in err
+    assert "Startup time:" in err
+    assert "Total time:" in err
+
+
+#
+# Test byte volume and line length statistics
+#
+def test_get_percentile():
+    values = range(1, 101)
+    assert reican.get_percentile(values, 50) == 50
+    assert reican.get_percentile(values, 99) == 99
+    assert reican.get_percentile([7], 95) == 7
+    assert reican.get_percentile([1, 2], 0) == 1
+
+
+def test_get_line_length_stats():
+    expected_result = {'max': 1000, 'p50': 10, 'p95': 1000, 'p99': 1000}
+    assert reican.get_line_length_stats([10, 1000, 10, 20]) == expected_result
+
+
+def test_analyze_stats_bytes():
+    """Test per hour byte volume with test/minidlna."""
+    stats = reican.Stats(test_file_name2)
+    stats = reican.parse_file(test_file_name2, stats)
+    stats = reican.analyze_stats(stats)
+    hour = arrow.get("2017-03-19 10:00:00")
+    assert stats.bytes == test_file_name2_bytes
+    assert stats.max_line_length == 280
+    assert stats.per_hour_bytes[hour] == 1158
+    assert stats.per_hour_line_length[hour]['max'] == 280
+    assert stats.per_hour_line_length[hour]['p50'] == 78
+    assert sum(stats.per_hour_bytes.values()) == stats.bytes
+
+
+def test_analyze_stats_compressed_bytes():
+    """Bytes per line must be based on uncompressed data."""
+    stats = reican.Stats(test_file_name2_compressed)
+    stats = reican.parse_file(test_file_name2_compressed, stats)
+    stats = reican.analyze_stats(stats)
+    assert stats.size < test_file_name2_bytes
+    assert stats.bytes == test_file_name2_bytes
+    assert stats.bytes_per_line == 101
+
+
+#
+# Test --compare
+#
+aggregation_a = {2017: {3: {19: {10: 9, 11: 2}}}}
+aggregation_b = {2017: {3: {19: {10: 3}, 20: {10: 1, 12: 4}}}}
+
+
+def test_get_buckets():
+    assert reican.get_buckets(aggregation_b, 'time') == {
+        (2017, 3, 19, 10): 3,
+        (2017, 3, 20, 10): 1,
+        (2017, 3, 20, 12): 4
+    }
+    assert reican.get_buckets(aggregation_b, 'hour') == {10: 4, 12: 4}
+
+
+def test_compare_aggregations():
+    comparison = reican.compare_aggregations(aggregation_a, aggregation_b,
+                                             'hour')
+    assert comparison == [(10, 9, 4, -5, 4 / 9.0), (11, 2, 0, -2, 0.0),
+                          (12, 0, 4, 4, None)]
+    movers = reican.get_biggest_movers(comparison, limit=2)
+    assert [row[0] for row in movers] == [10, 12]
+
+
+def test_export_aggregation(tmpdir):
+    """Exported aggregation must load back with integer keys."""
+    export_file_name = str(tmpdir.join("export.json"))
+    reican.export_aggregation(aggregation_a, export_file_name)
+    assert reican.load_aggregation(export_file_name) == aggregation_a
+
+
+def test_load_aggregation_invalid(tmpdir):
+    """A JSON file that is not an export must be rejected."""
+    for content in ['[1, 2]', '{"2017": 1}', '{"2017": {"3": {"19": {"x": 1}}}}',
+                    '{"2017": {"3": {"19": {"10": "a"}}}}', 'not json']:
+        export_file = tmpdir.join("invalid.json")
+        export_file.write(content)
+        with pytest.raises(SystemExit):
+            reican.load_aggregation(str(export_file))
+
+
+def test_args_compare_combinations():
+    """Options ignored by compare mode must be rejected."""
+    for extra_args in [["--output", "json"], ["--export", "out.json"],
+                       ["--group-by", "level"],
+                       ["--compare-export", "other.json"]]:
+        sys.argv = ["./reican.py", "some_file_name", "--compare",
+                    "other_file_name"] + extra_args
+        with pytest.raises(SystemExit):
+            reican.parse_args()
+
+
+def test_args_compare_export_combinations():
+    """--compare-export can not be combined with other compare inputs."""
+    sys.argv = ["./reican.py", "some_file_name", "--compare-export",
+                "other.json", "--date", "2017-03-25", "--compare-date",
+                "2017-03-26"]
+    with pytest.raises(SystemExit):
+        reican.parse_args()
+
+
+def test_main_compare_export_any_name(capsys, tmpdir):
+    """Exports are recognised by the option, not by the file extension."""
+    export_file_name = str(tmpdir.join("minidlna.out"))
+    sys.argv = ["./reican.py", "test/minidlna.log", "--export", export_file_name]
+    reican.main()
+    sys.argv = ["./reican.py", "test/minidlna.log", "--compare-export",
+                export_file_name, "--timing"]
+    reican.main()
+    out, err = capsys.readouterr()
+    assert "2017-03-19 10:00:00 9 9    +0  1.00" in out
+    assert "Total time:" in err
+
+
+def test_args_compare_date_requires_date():
+    sys.argv = ["./reican.py", "some_file_name", "--compare-date", "2017-03-25"]
+    with pytest.raises(SystemExit):
+        reican.parse_args()
+
+
+def test_main_compare_dates(capsys):
+    """Compare two days of test/minidlna.log by hour of day."""
+    sys.argv = [
+        "./reican.py", "test/minidlna.log", "--date", "2017-03-25",
+        "--compare-date", "2017-03-26", "--align", "hour"
+    ]
+    reican.main()
+    out, err = capsys.readouterr()
+    assert "aligned by hour of day" in out
+    assert "06:00               0 1    +1     -" in out
+    assert "17:00               2 0    -2  0.00" in out
+
+
+def test_main_compare_export(capsys, tmpdir):
+    """Compare test/minidlna.log against its own exported aggregation."""
+    export_file_name = str(tmpdir.join("minidlna.json"))
+    sys.argv = ["./reican.py", "test/minidlna.log", "--export", export_file_name]
+    reican.main()
+    sys.argv = ["./reican.py", "test/minidlna.log", "--compare-export",
+                export_file_name]
+    reican.main()
+    out, err = capsys.readouterr()
+    assert "2017-03-19 10:00:00 9 9    +0  1.00" in out
+    assert "Biggest movers:\n" in out
+
+
+#
+# Test multi-line records
+#
+def test_get_line_class():
+    assert reican.get_line_class("[2017/03/19 10:39:31] minidlna.c:1004: warn") == "["
+    assert reican.get_line_class("2015-10-30T20:20:11.563278+00:00 lalala") == "digit"
+    assert reican.get_line_class("\x00\x00[2017/03/19 10:39:57] minidlna.c") == "["
+    assert reican.get_line_class("INFO [2017/03/19 10:39:31] x") == "alpha"
+    assert reican.get_line_class("\tat com.example.Handler.handle(Handler.java:42)") == "space"
+    assert reican.get_line_class("\n") == "space"
+    assert reican.get_line_class("") is None
+
+
+def test_get_time_no_timestamp():
+    assert reican.get_time("\tat com.example.Server.run(Server.java:118)") is None
+
+
+def test_parse_file_records():
+    """Continuation lines in test/java.log are attached to the preceding record."""
+    stats = reican.Stats(test_file_name_java)
+    stats = reican.parse_file(test_file_name_java, stats)
+    assert sorted(stats.lines) == [1, 2, 8]
+    assert stats.line_continuations == {2: 5, 8: 3}
+    assert stats.continuation_lines == 8
+    assert stats.continuation_bytes == 212
+    assert stats.line_sizes[2] == 230
+    assert stats.orphan_lines == 0
+
+
+def test_parse_file_records_filter():
+    """Continuation lines of a filtered out record are skipped as well."""
+    stats = reican.Stats(test_file_name_java)
+    stats.filter_string = "INFO"
+    stats = reican.parse_file(test_file_name_java, stats)
+    assert sorted(stats.lines) == [1, 8]
+    assert stats.continuation_lines == 3
+
+
+def test_parse_file_records_filter_continuation(tmpdir):
+    """The filter string can match any line of the record."""
+    stats = reican.Stats(test_file_name_java)
+    stats.filter_string = "NullPointer"
+    stats = reican.parse_file(test_file_name_java, stats)
+    assert sorted(stats.lines) == [2]
+    assert stats.line_sizes[2] == 230
+    assert stats.continuation_lines == 5
+
+
+def test_parse_file_records_filter_parses_matching_only():
+    """Timestamps of records not matching the filter string are never parsed."""
+    stats = reican.Stats(test_file_name_java)
+    stats.filter_string = "NullPointer"
+    with mock.patch.object(
+            reican, "parse_timestamp", wraps=reican.parse_timestamp) as parse:
+        stats = reican.parse_file(test_file_name_java, stats)
+    assert parse.call_count == 1
+    assert stats.lines[2] == arrow.get("2017-06-12 09:15:03.548")
+
+
+def test_parse_file_records_date():
+    """Continuation lines of records from other days are skipped."""
+    stats = reican.Stats(test_file_name_java)
+    stats.filter_date = arrow.get("2017-06-13")
+    stats = reican.parse_file(test_file_name_java, stats)
+    assert stats.lines == {}
+    assert stats.continuation_lines == 0
+    assert stats.orphan_lines == 0
+
+
+def test_read_records_filter_digit_continuation(tmpdir):
+    """A continuation line starting with a digit must not end the record."""
+    log_file = tmpdir.join("digit.log")
+    log_file.write("2017-06-12 09:15:03.548 ERROR Request failed\n"
+                   "java.lang.NPE\n"
+                   "42 rows affected\n"
+                   "\tat com.example.Handler.handle(Handler.java:42)\n")
+    for filter_string in [None, "ERROR"]:
+        stats = reican.Stats(str(log_file))
+        stats.filter_string = filter_string
+        with open(str(log_file)) as logfile:
+            records = list(reican.read_records(logfile, stats))
+        assert len(records) == 1
+        assert records[0][2] == 124
+        assert records[0][3] == 3
+
+
+def test_parse_file_prefixed_timestamp(tmpdir):
+    """Timestamps do not have to be at the beginning of the line."""
+    log_file = tmpdir.join("prefixed.log")
+    log_file.write("INFO [2017/03/19 10:39:31] x\n"
+                   "  continued\n"
+                   "WARN [2017/03/19 11:02:00] y\n")
+    stats = reican.Stats(str(log_file))
+    stats = reican.parse_file(str(log_file), stats)
+    stats = reican.analyze_stats(stats)
+    assert stats.line_counter == 2
+    assert stats.orphan_lines == 0
+    assert stats.continuation_lines == 1
+    assert len(stats.per_hour_aggregation) == 2
+
+
+def test_analyze_stats_records():
+    """Test analyze_stats() with test/java.log."""
+    stats = reican.Stats(test_file_name_java)
+    stats = reican.parse_file(test_file_name_java, stats)
+    stats = reican.analyze_stats(stats)
+    hour = arrow.get("2017-06-12 09:00:00")
+    assert stats.line_counter == 3
+    assert stats.per_hour_aggregation[hour] == 2
+    assert stats.per_hour_continuations[hour] == 5
+    assert stats.per_hour_bytes[hour] == 280
+    assert stats.times['start'] == arrow.get("2017-06-12 09:15:02.120")
+
+
+#
+# Test --output json and csv
+#
+def test_read_records():
+    """read_records() yields each record with its continuation lines."""
+    stats = reican.Stats(test_file_name_java)
+    with open(test_file_name_java) as logfile:
+        records = list(reican.read_records(logfile, stats))
+    assert [record[0] for record in records] == [1, 2, 8]
+    assert [record[2] for record in records] == [50, 230, 72]
+    assert [record[3] for record in records] == [0, 5, 3]
+    assert records[1][4].startswith("2017-06-12 09:15:03.548 ERROR")
+
+
+def test_stream_buckets():
+    """Buckets are emitted one by one, in file order."""
+    rows = []
+    stats = reican.Stats(test_file_name2)
+    stats.group_by = reican.get_group_regex("level")
+    reican.stream_buckets(test_file_name2, stats, rows.append)
+    assert len(rows) == 11
+    assert stats.line_counter == 21
+    assert rows[0]['start'] == 1489917600
+    assert rows[0]['time'] == "2017-03-19 10:00:00"
+    assert rows[0]['lines'] == 9
+    assert rows[0]['bytes'] == 1158
+    assert rows[0]['max'] == 280
+    assert rows[0]['groups'] == {"warn": 9}
+    assert rows[-1]['groups'] == {"error": 1}
+
+
+def test_main_output_json(capsys):
+    """Test --output json against test/java.log."""
+    import json
+    sys.argv = ["./reican.py", test_file_name_java, "--output", "json"]
+    reican.main()
+    out, err = capsys.readouterr()
+    rows = [json.loads(line) for line in out.splitlines()]
+    assert [row['lines'] for row in rows] == [2, 1]
+    assert [row['continuations'] for row in rows] == [5, 3]
+    assert "groups" not in rows[0]
+
+
+def test_main_output_csv(capsys):
+    """Test --output csv against test/test.log."""
+    sys.argv = ["./reican.py", test_file_name, "--output", "csv"]
+    reican.main()
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0] == ",".join(reican.OUTPUT_FIELDS)
+    assert lines[1] == "1446285600,2015-10-31 10:00:00,1,73,0,73,73,73,73"
+    assert len(lines) == 4
+
+
+def test_stream_buckets_utc_offset(tmpdir):
+    """Streamed buckets use the same hours as the text output."""
+    log_file = tmpdir.join("offset.log")
+    log_file.write("2017-06-12T23:30:00+02:00 a\n"
+                   "2017-06-12T23:50:00+02:00 b\n"
+                   "2017-06-13T00:10:00+02:00 c\n")
+    rows = []
+    stats = reican.Stats(str(log_file))
+    reican.stream_buckets(str(log_file), stats, rows.append)
+    assert [row['time'] for row in rows] == ["2017-06-12 23:00:00",
+                                             "2017-06-13 00:00:00"]
+    # 'start' stays a real epoch: 2017-06-12 21:00:00 UTC
+    assert rows[0]['start'] == 1497301200
+    assert "offset" not in rows[0]
+    stats = reican.Stats(str(log_file))
+    stats = reican.analyze_stats(reican.parse_file(str(log_file), stats))
+    hours = sorted(stats.per_hour_aggregation)
+    assert [hour.format(reican.TIMESTAMP_FORMAT) for hour in hours] == [
+        row['time'] for row in rows]
+
+
+def test_args_output_combinations():
+    """--export and csv --group-by are not supported with streamed output."""
+    for extra_args in [["--output", "json", "--export", "out.json"],
+                       ["--output", "csv", "--group-by", "level"]]:
+        sys.argv = ["./reican.py", "some_file_name"] + extra_args
+        with pytest.raises(SystemExit):
+            reican.parse_args()
+
+
+class ClosedPipe:
+    """File object that behaves like a pipe closed by the reader after 'lines' writes."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.written = []
+
+    def write(self, data):
+        if len(self.written) >= self.lines:
+            import errno
+            raise IOError(errno.EPIPE, "Broken pipe")
+        self.written.append(data)
+
+    def flush(self):
+        pass
+
+
+def test_stream_buckets_closed_output():
+    """Reading stops quietly once the reader closes the output."""
+    output_file = ClosedPipe(2)
+    stats = reican.Stats(test_file_name2)
+    reican.stream_buckets(test_file_name2, stats,
+                          reican.get_emitter("json", output_file))
+    assert len(output_file.written) == 2
+    # the third bucket could not be written, the rest of the file is not read
+    assert stats.line_counter < 21
+
+
+def test_get_emitter_closed_output_csv():
+    """The csv header can hit a closed output too."""
+    emit = reican.get_emitter("csv", ClosedPipe(0))
+    assert emit({"start": 0}) is False
+
+
+def test_stream_buckets_max_lines(capsys):
+    """Streaming dies like the text output when MAX_LINES_TO_READ is reached."""
+    rows = []
+    stats = reican.Stats(test_file_name2)
+    with mock.patch.object(reican, "MAX_LINES_TO_READ", 5):
+        with pytest.raises(SystemExit):
+            reican.stream_buckets(test_file_name2, stats, rows.append)
+    out, err = capsys.readouterr()
+    assert "Max lines limit was reached" in err
+    assert rows == []
+
+
+def test_stream_buckets_flush_on_skipped_record(tmpdir):
+    """A bucket is emitted as soon as any record from a later hour is read."""
+    log_file = tmpdir.join("skipped.log")
+    log_file.write("[2017/03/19 10:39:31] needle\n" +
+                   "[2017/03/19 11:00:00] hay\n" * 10 +
+                   "[2017/03/19 12:00:00] needle\n")
+    emitted_after = []
+    get_timestamp = mock.Mock(wraps=reican.get_timestamp)
+
+    def emit(row):
+        emitted_after.append(get_timestamp.call_count)
+
+    stats = reican.Stats(str(log_file))
+    stats.filter_string = "needle"
+    with mock.patch.object(reican, "get_timestamp", get_timestamp):
+        reican.stream_buckets(str(log_file), stats, emit)
+    # first bucket goes out right after the first 11:00 line
+    assert emitted_after == [2, 12]
+
+
+def test_get_hour_key():
+    assert reican.get_hour_key("2017/03/19 10:39:31") == "2017/03/19 10"
+    assert reican.get_hour_key("2015-10-30T20:20:11.563278+00:00") == "2015-10-30T20"
+    assert reican.get_hour_key("1446314353.403") == reican.get_hour_key(
+        "1446314399.999")
+    assert reican.get_hour_key("1446314353.403") != reican.get_hour_key(
+        "1446318000.000")